@@ -43,6 +43,7 @@ def confirm(prompt):
 def list_entries(section):
 
     padding = indent * ' '
+    lines = []
 
     for name, params in section.items():
 
@@ -50,17 +51,20 @@ def list_entries(section):
             sys.stderr.write(f"WARNING: invalid entry '{name}'\n\n")
             continue
 
-        print(f'{name}')
+        lines.append(f'{name}')
 
         for kw, val in params.items():
             if isinstance(val, list):
-                print(f'{padding}{kw}')
-                for item in val:
-                    print(f'{2*padding}{item}')
+                lines.append(f'{padding}{kw}')
+                lines.extend(f'{2*padding}{item}' for item in val)
             else:
-                print(f'{padding}{kw} {val}')
+                lines.append(f'{padding}{kw} {val}')
 
-        print()
+        lines.append('')
+
+    # Emit the whole listing in a single write, rather than line by line:
+    if lines:
+        sys.stdout.write('\n'.join(lines) + '\n')
 
 
 def write_config(config, filename):
@@ -69,7 +73,9 @@ def write_config(config, filename):
 
     with open(os.open(filename, os.O_CREAT|os.O_WRONLY|os.O_TRUNC, mode=0o600),
               mode='w') as config_fd:
-        config_fd.write(json.dumps(config, indent=indent))
+        # Stream directly to the file, rather than constructing the complete
+        # JSON document in memory first:
+        json.dump(config, config_fd, indent=indent)
 
 
 def main():
@@ -102,12 +108,13 @@ def main():
 
     # Read any existing config, defaulting to an empty one:
     config, conf_errs = get_config(config_file)
+    names = config.setdefault('names', {})
 
     if args.name is None:
-        section = config['names']
+        section = names
     else:
-        if args.name in config['names']:
-            section = {args.name : config['names'][args.name]}
+        if args.name in names:
+            section = {args.name : names[args.name]}
         elif args.cmd in ('del', 'list'):
             # Error if user tries to list or delete a non-existent entry:
             invocation_err(f"entry '{args.name}' not found")
@@ -132,14 +139,14 @@ def main():
             invocation_err(e)
 
         modified = True
-        if args.name in config['names']:
+        if args.name in names:
             list_entries(section)
             if not confirm(f'Replace existing entry {args.name}?'):
                 modified = False
                 print('Aborted')
 
         if modified:
-            config['names'][args.name] = vm_args
+            names[args.name] = vm_args
 
     # Delete one or all entries:
     elif args.cmd == 'del':
@@ -152,9 +159,9 @@ def main():
 
         if modified:
             if args.name is None:
-                config['names'] = {}
+                names.clear()
             else:
-                del config['names'][args.name]
+                names.pop(args.name, None)
         else:
             print('Aborted')
 
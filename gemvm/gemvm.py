@@ -11,13 +11,14 @@ import argparse
 import asyncio
 import contextlib
 import curses
-import functools
 import json
 import os
-import shlex
+import random
+import shutil
 import signal
 import subprocess
 import sys
+import tempfile
 import time
 import traceback
 
@@ -37,6 +38,14 @@ def standardize_paths(filenames):
     return list(dict.fromkeys([os.path.realpath(os.path.expanduser(filename))
                                for filename in filenames]))
 
+def _ssh_backoff(base=0.25, cap=8.0, jitter=0.25):
+    """Generate exponentially-increasing retry delays with random jitter"""
+    attempt = 0
+    while True:
+        yield min(cap, base * 2**attempt) * (1 + random.uniform(-jitter,
+                                                                jitter))
+        attempt += 1
+
 def check_file_access(filenames):
     mode = os.R_OK | os.W_OK  # need +w unless "-drive media=cdrom"
     for filename in filenames:
@@ -77,12 +86,18 @@ class VMControl:
         self.flush_log = flush_log
 
         self.log_file = f'gemvm_{self.title}.log'
-        self.qmp_sock = os.path.join(os.sep, 'tmp', f'.gemvm_qmp_{os.getpid()}')
+        self._sock_dir = None  # created in _run, removed again on completion
+        self.qmp_sock = None
 
         self._state = 'off'
+        self._state_event = asyncio.Event()  # notifies on state changes
+        self._off_event = asyncio.Event()      # set once state goes to 'off'
+        self._booting_done = asyncio.Event()   # set on leaving 'booting'
         self._qmp_established = False
         self._tasks = {}
         self._log_fd = None
+        self._last_ts_sec = 0   # memoize log timestamps to the second
+        self._last_ts_str = ''
         self._shutdown_msg = 'Shutdown requested'
         self._info = (
             f'Once booted, log in with:\n'
@@ -104,6 +119,11 @@ class VMControl:
     def state(self, state):
         if state in self.states:
             self._state = state
+            self._state_event.set()  # wake anything observing the state
+            if state != 'booting':
+                self._booting_done.set()
+            if state == 'off':
+                self._off_event.set()
         else:
             raise ValueError(f'Invalid VM state: {state}')
 
@@ -121,24 +141,28 @@ class VMControl:
             disk_type = 'ide'
             net_type = 'e1000e'
 
-        args = [
-            f'-drive file={disk_image},index={n},if={disk_type},cache=off'
-            for n, disk_image in enumerate(self.disk_images)
-        ]
+        # These are already tokenized ready for exec (without shell quoting),
+        # so values such as the title can safely contain spaces:
+        args = []
+        for n, disk_image in enumerate(self.disk_images):
+            args.extend((
+                '-drive',
+                f'file={disk_image},index={n},if={disk_type},cache=off',
+            ))
         args.extend((
-            f'-m {self.mem}G',
-            f'-name "{self.title}"',
-            f'-machine type=q35,accel=hvf:kvm:tcg',
-            f'-smp 2',
-            f'-boot menu=off',
-            f'-qmp unix:{self.qmp_sock},server,nowait',
-            f'-device {net_type},netdev=net0',
-            f'-netdev user,id=net0,hostfwd=tcp:127.0.0.1:{self.port}-:22',
+            '-m', f'{self.mem}G',
+            '-name', self.title,
+            '-machine', 'type=q35,accel=hvf:kvm:tcg',
+            '-smp', '2',
+            '-boot', 'menu=off',
+            '-qmp', f'unix:{self.qmp_sock},server,nowait',
+            '-device', f'{net_type},netdev=net0',
+            '-netdev', f'user,id=net0,hostfwd=tcp:127.0.0.1:{self.port}-:22',
         ))
         if self.console is False:
             args.extend((
-                f'-vga none',
-                f'-nographic',
+                '-vga', 'none',
+                '-nographic',
             ))
         return args
 
@@ -156,8 +180,14 @@ class VMControl:
     def log(self, msg, time_stamp=True):
         with self.log_context() as log_fd:
             if time_stamp:
-                ts = time.strftime("%H:%M:%S", time.localtime())
-                log_fd.write(f'{ts}  {msg}\n')
+                # Only re-format the timestamp when the second has changed,
+                # in case of bursts of messages (eg. QMP event streams):
+                now = int(time.time())
+                if now != self._last_ts_sec:
+                    self._last_ts_str = time.strftime("%H:%M:%S",
+                                                      time.localtime(now))
+                    self._last_ts_sec = now
+                log_fd.write(f'{self._last_ts_str}  {msg}\n')
             else:
                 log_fd.write(f'{msg}\n')
             if self.flush_log:
@@ -181,24 +211,29 @@ class VMControl:
                f"state='{self.state}', qmp_established={self.qmp_established}, "
                f"timed_out={self.timed_out}, exit_status={self.exit_status})>")
 
-    def _keyboard_interrupt(self, events):
-        events['shutdown_request'].set()
-        self.log(self._shutdown_msg)
-
     async def _run_vm(self, events):
 
-        # Open log separately for subprocess, which needs to use binary mode
-        # (the process will get its own copy of the file handle in any case):
-        with open(self.log_file, 'a+b') as log_fd:
+        # Share the persistent log descriptor with the subprocess (which gets
+        # its own duplicate of it), rather than opening the same file a second
+        # time; both write in append mode, so they can't overwrite each other.
+        # Flush first, so lines buffered by this script don't land in the log
+        # after later subprocess output:
+        with self.log_context() as log_fd:
+
+            log_fd.flush()
 
             try:
                 # Run VM in background session so it doesn't die on ctrl-c,
-                # capturing all output to the log:
+                # capturing all output to the log. QEMU never reads its input
+                # here, so that can come from /dev/null (rather than a pipe,
+                # which would also stop subprocess using posix_spawn where
+                # available), but it mustn't inherit the terminal, which
+                # curses is using:
                 proc = await asyncio.create_subprocess_exec(
                        self.cmd,
-                       *shlex.split(' '.join(self.cmd_args)), # split opts+args
-                       stdin=subprocess.PIPE,
-                       stdout=log_fd,
+                       *self.cmd_args,
+                       stdin=subprocess.DEVNULL,
+                       stdout=log_fd.fileno(),
                        stderr=subprocess.STDOUT,
                        start_new_session=True,
                 )
@@ -239,23 +274,30 @@ class VMControl:
             # a for a memory allocation error (which qemu's exit code doesn't
             # distinguish from other errors), so we can advise the user on what
             # to do. This message appears not to change with the user's locale.
+            # QEMU emits it at startup, so only the first 64KB needs searching
+            # (avoiding a line-by-line scan of a potentially large log). This
+            # needs a separate read-only handle in binary mode, but only in
+            # the error path:
             if self.exit_status == 1:
-                log_fd.seek(0, 0)
-                for line in log_fd:
-                    if b'cannot set up guest memory' in line:
+                with open(self.log_file, 'rb') as qemu_log:
+                    if b'cannot set up guest memory' in qemu_log.read(65536):
                         self.mem_err = True
-                        break
-                log_fd.seek(0, 2)  # return to end
 
 
     async def _wait_until_booted(self, events):
 
-        while self.state == 'booting':
+        # Retry with exponential backoff (rather than at fixed intervals), to
+        # catch quick boots promptly without polling a slow one every second:
+        backoff = _ssh_backoff()
+
+        # The loop exits via the event (set by whichever task moves the state
+        # on), rather than re-reading the state string on every retry:
+        while not self._booting_done.is_set():
             self.log('Attempt ssh connection')
             try:
                 await self._check_ssh()
             except ConnectionError:
-                await asyncio.sleep(1)  # retry port after 1s
+                await asyncio.sleep(next(backoff))  # retry port after backoff
             else:
                 self.state = 'running'
                 self._cancel_tasks('_boot_timer')  # unblock event loop exit
@@ -273,17 +315,22 @@ class VMControl:
         reader, writer = await asyncio.open_connection(
             host='127.0.0.1', port=self.port
         )
+        # Only the 8-byte protocol prefix of the banner is of interest, so
+        # read exactly that (with a time-out, in case the server accepts the
+        # connection but never replies), instead of scanning a whole line.
         # This occasionally gets EOF instead of the expected reply (presumably
         # because of some time-out or the server not being ready yet, as when
         # the ssh client briefly produces "read: Connection reset by peer"):
         try:
-            reply = await reader.readline()
+            reply = await asyncio.wait_for(reader.readexactly(8), timeout=2.)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+            reply = b''
         finally:
             writer.close()
 
         self.log(f'Reply {reply} from guest ssh service')
 
-        if not reply.startswith(b'SSH-2.0-'):
+        if reply != b'SSH-2.0-':
             raise ConnectionError(
                 f'Bad reply "{reply}" from guest ssh service.'
             )
@@ -342,7 +389,14 @@ class VMControl:
 
             stdscr.refresh()
 
-            await asyncio.sleep(1)
+            # Sleep until notified of a state change (rather than polling
+            # every second), waking every few seconds anyway to update the
+            # heartbeat / counter and pick up any terminal re-sizing:
+            try:
+                await asyncio.wait_for(self._state_event.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                pass
+            self._state_event.clear()
 
         # If anything has gone wrong (eg. QMP), add a warning to the status?
 
@@ -363,15 +417,22 @@ class VMControl:
     async def _shut_down(self, events):
 
         # Can't shut down reliably until finished booting (already scheduled):
-        await asyncio.wait_for(self._tasks['_wait_until_booted'], timeout=None)
+        await self._tasks['_wait_until_booted']
 
-        # If any of the following fails, just log the exception and time out in
-        # a separate co-routine, rather than catching the error.
+        # Anticipated QMP failures below are a degraded mode, not fatal: log
+        # them and return, leaving _shutdown_timer to time out instead. An
+        # uncaught exception here would abort the whole task group, ending
+        # the session while QEMU may still be running.
 
         # Open the QMP socket for communicating with QEMU.
         # Here we'll get a ConnectionRefusedError if the socket can't be opened
         # (eg. because overwritten) or FileNotFoundError if it doesn't exist.
-        reader, writer = await asyncio.open_unix_connection(self.qmp_sock)
+        try:
+            reader, writer = await asyncio.open_unix_connection(self.qmp_sock)
+        except (ConnectionError, FileNotFoundError) as e:
+            self.log(f'QMP unavailable ({e!r}); falling back to shutdown '
+                     f'timer')
+            return
 
         try:
             self.log(f'Opened socket {self.qmp_sock}')
@@ -393,17 +454,34 @@ class VMControl:
 
             # Now we're ready to shut down as soon as the signal arrives:
             await events['shutdown_request'].wait()
+            self.log(self._shutdown_msg)
             writer.write(b'{"execute": "system_powerdown"}\r\n')
             self.state = 'shutting_down'  # wait for {'event' : 'POWERDOWN'} ?
             self.log('Sent system_powerdown command')
             while self.state != 'off':
-                reply = json.loads(await reader.readline())
+                line = await reader.readline()
+                # Stop if the connection drops (without this, readline()
+                # returns b'' at EOF without ever suspending and the loop
+                # would spin, starving the other tasks):
+                if not line:
+                    raise ConnectionError(
+                        f'QMP connection at {self.qmp_sock} closed '
+                        f'unexpectedly'
+                    )
+                # Cheap substring test to skip JSON parsing for the many
+                # uninteresting events (RTC_CHANGE, POWERDOWN etc.):
+                if b'"SHUTDOWN"' not in line:
+                    continue
+                reply = json.loads(line)
                 if 'event' in reply and reply['event'] == 'SHUTDOWN':
                     # The VM has shut down, but self.state gets set to 'off'
                     # by _run_vm, when the process exits a couple of sec later.
                     # Log this confirmation (& POWERDOWN) in a later version.
                     break
 
+        except ConnectionError as e:
+            self.log(f'{e!r}; falling back to shutdown timer')
+
         finally:
             writer.close()
 
@@ -414,15 +492,20 @@ class VMControl:
     async def _shutdown_timer(self, events):
 
         # Can't shut down until we're asked to *and* the VM has booted:
-        await asyncio.wait_for(self._tasks['_wait_until_booted'], timeout=None)
+        await self._tasks['_wait_until_booted']
 
         await events['shutdown_request'].wait()
 
-        # Shutdown normally takes about 2-6s with a minimal OS install
-        await asyncio.sleep(self.shutdown_timeout)
-        self.timed_out = True
-        self.log('Shutdown timed out')
-        self._cancel_tasks()
+        # Shutdown normally takes about 2-6s with a minimal OS install. This
+        # just ends quietly if the VM turns off within the allowed time,
+        # instead of leaving a stale timer to be cancelled by _run_vm:
+        try:
+            await asyncio.wait_for(self._off_event.wait(),
+                                   timeout=self.shutdown_timeout)
+        except asyncio.TimeoutError:
+            self.timed_out = True
+            self.log('Shutdown timed out')
+            self._cancel_tasks()
 
     async def _run(self, stdscr):
 
@@ -437,60 +520,80 @@ class VMControl:
         except OSError:
             pass
 
-        # Hold log file open during execution of the main routine:
-        with self.log_context() as log_fd:
-
-            loop = asyncio.get_running_loop()
-            events = {
-                'shutdown_request' : asyncio.Event(),
-            }
-            loop.add_signal_handler(
-                signal.SIGINT,
-                functools.partial(self._keyboard_interrupt, events)
-            )
-
-            self.state = 'booting'
-
-            self._tasks = {
-                name : asyncio.create_task(getattr(self, name)(events)) for
-                  name in (
-                      '_run_vm',
-                      '_wait_until_booted',
-                      '_boot_timer',
-                      '_shut_down',
-                      '_shutdown_timer',
-                  )
-            }
-            self._tasks['_progress'] = asyncio.create_task(
-                self._progress(events, stdscr)  # this one has an extra arg
-            )
-
-            self.log('', time_stamp=False)
-            self.log('Starting event loop')
-
-            # Main event loop (saving any exceptions for later):
-            retvals = await asyncio.gather(*self._tasks.values(),
-                                           return_exceptions=True)
-
-            self.log(f'{self}')
+        # Keep the QMP socket in a private temporary directory, so that its
+        # path is neither predictable nor accessible to other local users
+        # (only created here, alongside the removal below, so that instances
+        # that never run don't leave anything behind):
+        self._sock_dir = tempfile.mkdtemp(prefix='gemvm.')
+        self.qmp_sock = os.path.join(self._sock_dir, 'qmp')
 
-            # Append any internal exceptions to the log:
-            errors = []
-            for retval in retvals:
-                if isinstance(retval, Exception) and not \
-                   isinstance(retval, asyncio.CancelledError):
-                    errors.append('\n')
-                    errors.extend(
-                        traceback.format_exception(type(retval), retval,
-                                                   retval.__traceback__)
+        try:
+            # Hold log file open during execution of the main routine:
+            with self.log_context() as log_fd:
+
+                loop = asyncio.get_running_loop()
+                events = {
+                    'shutdown_request' : asyncio.Event(),
+                }
+                # Just set the event on ctrl-c (logging it where it gets
+                # acted on, not in the signal handler):
+                loop.add_signal_handler(signal.SIGINT,
+                                        events['shutdown_request'].set)
+
+                self.state = 'booting'
+
+                # Main event loop: run all the tasks in a single structured
+                # cancellation scope, saving any exceptions for later. Tasks
+                # cancelled individually via _cancel_tasks (in normal
+                # operation) don't abort the group, but an unexpected failure
+                # in one task cancels the others cleanly, instead of the
+                # shutdown sequence racing or hanging:
+                errors = []
+                try:
+                    async with asyncio.TaskGroup() as tg:
+                        self._tasks = {
+                            name : tg.create_task(getattr(self, name)(events),
+                                                  name=name) for
+                              name in (
+                                  '_run_vm',
+                                  '_wait_until_booted',
+                                  '_boot_timer',
+                                  '_shut_down',
+                                  '_shutdown_timer',
+                              )
+                        }
+                        self._tasks['_progress'] = tg.create_task(
+                            self._progress(events, stdscr),  # has an extra arg
+                            name='_progress'
+                        )
+
+                        self.log('', time_stamp=False)
+                        self.log('Starting event loop')
+
+                # Append any internal exceptions to the log:
+                except* Exception as eg:
+                    for exc in eg.exceptions:
+                        errors.append('\n')
+                        errors.extend(
+                            traceback.TracebackException.from_exception(
+                                exc).format()
+                        )
+
+                self.log(f'{self}')
+
+                if errors:
+                    self.log(
+                        '-'*78 + '\n'
+                        'Errors were produced while running the control '
+                        'script:\n' +
+                        ''.join(errors),
+                        time_stamp=False
                     )
-            if errors:
-                self.log(
-                    '-'*78 + '\n'
-                    'Errors were produced while running the control script:\n' +
-                    ''.join(errors),
-                    time_stamp=False
-                )
+
+        finally:
+            # Remove the private socket directory (and QEMU's socket with
+            # it), tolerating prior removal:
+            shutil.rmtree(self._sock_dir, ignore_errors=True)
 
     def _cancel_tasks(self, *names):
         if not names:
@@ -647,10 +750,11 @@ def main():
         vm.log(msg, time_stamp=False)
 
     else:
+        # Collect the applicable messages and write them all at once below:
+        msgs = []
+
         if vm.timed_out:
-            msg = f'\nTimed out while {vm.state.replace("_", " ")}.'
-            sys.stderr.write(msg + '\n')
-            vm.log(msg, time_stamp=False)
+            msgs.append(f'\nTimed out while {vm.state.replace("_", " ")}.')
 
         end = f'see {vm.log_file}\n'
         if exit_status is None:
@@ -675,20 +779,24 @@ def main():
                 msg = (f'\nVM process completed with error status '
                        f'{exit_status}: {end}')
 
-        sys.stderr.write(msg + '\n')
-        vm.log(msg, time_stamp=False)
+        msgs.append(msg)
 
         if vm.mem_err:
-            msg = (f'It looks like QEMU failed to allocate {vm.mem}GB of '
-                   f'contiguous memory to run the VM.\n\n'
-                   f'Try restarting large programs such as your Web browser, '
-                   f'to reduce memory\nfragmentation (or closing them '
-                   f'entirely if that doesn\'t solve it). If the\nproblem '
-                   f'persists, try reducing the "mem" parameter value '
-                   f'(without going below\n0.25 to 0.5GB for tolerable '
-                   f'performance with a minimal OS installation).\n')
-            sys.stderr.write(msg + '\n')
-            vm.log(msg, time_stamp=False)
+            msgs.append(
+                f'It looks like QEMU failed to allocate {vm.mem}GB of '
+                f'contiguous memory to run the VM.\n\n'
+                f'Try restarting large programs such as your Web browser, '
+                f'to reduce memory\nfragmentation (or closing them '
+                f'entirely if that doesn\'t solve it). If the\nproblem '
+                f'persists, try reducing the "mem" parameter value '
+                f'(without going below\n0.25 to 0.5GB for tolerable '
+                f'performance with a minimal OS installation).\n'
+            )
+
+        # A single write each for the terminal & log (same output as before):
+        msg = '\n'.join(msgs)
+        sys.stderr.write(msg + '\n')
+        vm.log(msg, time_stamp=False)
 
     sys.exit(1 if exit_status is None else exit_status)
 